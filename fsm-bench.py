@@ -0,0 +1,342 @@
+#!/usr/bin/python3
+
+# Benchmarks for the FSM module.
+# Each benchmark is a sub-command; run with no parameters for syntax.
+#
+# threads:  I/O-bound machines against a local stand-in service,
+#           dispatched on 1..N worker threads to show scaling.
+# rle:      fsm-rle.py and urle.py throughput with 1..N worker
+#           processes (--jobs) on a generated file.
+# dispatch: raw transitions/s of a CPU-bound machine, with and without
+#           the dispatcher's step/time/cycle guards and metrics.
+# scheduler: completion latency of short machines sharing one thread
+#           with a long-running one, run to completion vs time-sliced.
+# startup:  interpreter start + import cost of the module and tools,
+#           from wall-clock spawns and "python -X importtime".
+
+from fsm import Context, State, Dispatcher, ThreadedDispatcher, Scheduler
+from fsmmetrics import Metrics
+import os
+import random
+import socket
+import socketserver
+import subprocess
+import tempfile
+import threading
+import time
+import sys
+argv=sys.argv
+argc=(len(argv))
+
+### Local stand-in service ###
+
+# Echoes each request line back after a fixed delay, standing in for
+# a remote database or web service.  One thread per connection.
+class StandInHandler(socketserver.StreamRequestHandler):
+   def handle(self):
+      for line in self.rfile:
+         time.sleep(self.server.latency)
+         self.wfile.write(line)
+
+class StandInService(socketserver.ThreadingTCPServer):
+   daemon_threads=True
+   allow_reuse_address=True
+
+   def __init__(self, latency):
+      super().__init__(("127.0.0.1", 0), StandInHandler)
+      self.latency=latency
+      threading.Thread(target=self.serve_forever, daemon=True).start()
+
+   def address(self):
+      return (self.server_address)
+
+### I/O-bound machine ###
+
+class Connect(State):
+   def __init__(self, stateName):
+      super().__init__("Connect")
+
+   def run(self, context):
+      sock=socket.create_connection(context.get("address"))
+      context.set("socket", sock)
+      context.set("stream", sock.makefile("rwb"))
+      context.setNextState("Request")
+
+class Request(State):
+   def __init__(self, stateName):
+      super().__init__("Request")
+
+   def run(self, context):
+      stream=context.get("stream")
+      n=context.get("remaining")
+      stream.write(b"%d\n" % n)
+      stream.flush()
+      if (int(stream.readline())!=n):
+         raise RuntimeError("Stand-in service returned a bad reply")
+      context.set("remaining", n-1)
+      if (n>1):
+         context.setNextState("Request")
+      else:
+         context.setNextState("Disconnect")
+
+class Disconnect(State):
+   def __init__(self, stateName):
+      super().__init__("Disconnect")
+
+   def run(self, context):
+      context.get("stream").close()
+      context.get("socket").close()
+      context.setNextState(None)
+
+def newMachines(count, requests, address):
+   contexts=[]
+   for i in range(count):
+      context=Context(f"Machine{i}")
+      context.set("address", address)
+      context.set("remaining", requests)
+      context.setNextState("Connect")
+      contexts.append(context)
+   return (contexts)
+
+def benchThreads(maxThreads):
+   machines=32
+   requests=10
+   latency=0.002
+   service=StandInService(latency)
+   print(f"{machines} machines x {requests} requests, {latency*1000:.1f}ms service latency")
+   print(f"{'threads':>8} {'seconds':>9} {'machines/s':>11} {'speedup':>8}")
+
+   baseline=None
+   threads=1
+   while (threads<=maxThreads):
+      contexts=newMachines(machines, requests, service.address())
+      start=time.perf_counter()
+      if (threads==1):
+         dispatcher=Dispatcher()
+         for context in contexts:
+            dispatcher.dispatch(context)
+      else:
+         with ThreadedDispatcher(threads) as dispatcher:
+            dispatcher.dispatchAll(contexts)
+      elapsed=time.perf_counter()-start
+      if (baseline==None):
+         baseline=elapsed
+      print(f"{threads:>8} {elapsed:>9.3f} {machines/elapsed:>11.1f} {baseline/elapsed:>7.2f}x")
+      threads*=2
+
+   service.shutdown()
+
+### Dispatch overhead ###
+
+class Ping(State):
+   def __init__(self, stateName):
+      super().__init__("Ping")
+
+   def run(self, context):
+      context.setNextState("Pong")
+
+class Pong(State):
+   def __init__(self, stateName):
+      super().__init__("Pong")
+
+   def run(self, context):
+      n=context.get("remaining")-1
+      context.set("remaining", n)
+      if (n>0):
+         context.setNextState("Ping")
+      else:
+         context.set("finished", time.perf_counter())
+         context.setNextState(None)
+
+def timeDispatch(dispatcher, transitions):
+   context=Context("Ping-Pong")
+   context.set("remaining", transitions//2)
+   context.setNextState("Ping")
+   start=time.perf_counter()
+   dispatcher.dispatch(context)
+   return (time.perf_counter()-start)
+
+def benchDispatch(transitions):
+   configs=[("no guards", Dispatcher()),
+            ("maxSteps", Dispatcher(maxSteps=10*transitions)),
+            ("maxSteps+maxTime", Dispatcher(maxSteps=10*transitions, maxTime=3600)),
+            ("cycle detection", Dispatcher(cycleKeys=["remaining"])),
+            ("all guards", Dispatcher(maxSteps=10*transitions, maxTime=3600,
+                                      cycleKeys=["remaining"])),
+            ("metrics", Dispatcher(metrics=Metrics()))]
+   print(f"{transitions:,} transitions, best of 5")
+   print(f"{'dispatcher':<18} {'transitions/s':>14} {'overhead':>9}")
+   baseline=None
+   for name, dispatcher in configs:
+      best=min(timeDispatch(dispatcher, transitions) for i in range(5))
+      if (baseline==None):
+         baseline=best
+      print(f"{name:<18} {transitions/best:>14,.0f} {(best/baseline-1)*100:>8.1f}%")
+
+### Scheduler latency ###
+
+def newPingPong(name, transitions):
+   context=Context(name)
+   context.set("remaining", transitions//2)
+   context.setNextState("Ping")
+   return (context)
+
+def percentile(values, p):
+   values=sorted(values)
+   return (values[min(len(values)-1, int(len(values)*p))])
+
+def benchScheduler(longTransitions, shortMachines):
+   shortTransitions=20
+   print(f"1 machine x {longTransitions:,} transitions, then {shortMachines} x {shortTransitions} transitions")
+   print(f"{'mode':<22} {'total s':>8} {'short p50 ms':>13} {'short p99 ms':>13}")
+
+   # Run to completion, in arrival order
+   contexts=[newPingPong("long", longTransitions)]
+   contexts+=[newPingPong(f"short{i}", shortTransitions) for i in range(shortMachines)]
+   dispatcher=Dispatcher()
+   start=time.perf_counter()
+   for context in contexts:
+      dispatcher.dispatch(context)
+   report("dispatch (sequential)", start, contexts)
+
+   # Time-sliced
+   for quantum in (16, 256):
+      contexts=[newPingPong("long", longTransitions)]
+      contexts+=[newPingPong(f"short{i}", shortTransitions) for i in range(shortMachines)]
+      scheduler=Scheduler(quantum=quantum)
+      start=time.perf_counter()
+      for context in contexts:
+         scheduler.add(context)
+      scheduler.run()
+      report(f"Scheduler quantum={quantum}", start, contexts)
+
+def report(mode, start, contexts):
+   total=max(c.get("finished") for c in contexts)-start
+   latencies=[(c.get("finished")-start)*1000 for c in contexts[1:]]
+   print(f"{mode:<22} {total:>8.3f} {percentile(latencies, 0.5):>13.2f} {percentile(latencies, 0.99):>13.2f}")
+
+### RLE throughput ###
+
+# Writes a file of mixed runs and noise, roughly what raw images look like
+def makeRLEInput(path, megabytes):
+   rnd=random.Random(6722301)
+   chunk=bytearray()
+   while (len(chunk)<1024*1024):
+      if (rnd.random()<0.5):
+         chunk+=bytes((rnd.randrange(256),))*rnd.randrange(3, 400)
+      else:
+         chunk+=rnd.randbytes(rnd.randrange(1, 200))
+   file=open(path, "wb")
+   for i in range(megabytes):
+      file.write(chunk[:1024*1024])
+   file.close()
+
+def timeTool(args):
+   start=time.perf_counter()
+   subprocess.run([sys.executable]+args, check=True, stdout=subprocess.DEVNULL)
+   return (time.perf_counter()-start)
+
+def benchRLE(megabytes, maxJobs):
+   here=os.path.dirname(os.path.abspath(__file__))
+   print(f"{megabytes} MB input, {os.cpu_count()} CPUs")
+   print(f"{'jobs':>5} {'encode MB/s':>12} {'decode MB/s':>12}")
+   with tempfile.TemporaryDirectory() as tmp:
+      infile=os.path.join(tmp, "input.bin")
+      makeRLEInput(infile, megabytes)
+      jobs=1
+      while (jobs<=maxJobs):
+         enc=timeTool([os.path.join(here, "fsm-rle.py"), infile, f"--jobs={jobs}"])
+         dec=timeTool([os.path.join(here, "urle.py"), infile+".rle",
+                       os.path.join(tmp, "output.bin"), f"--jobs={jobs}"])
+         print(f"{jobs:>5} {megabytes/enc:>12.1f} {megabytes/dec:>12.1f}")
+         jobs*=2
+
+### Startup ###
+
+# Sums the self time (us) of every import reported by -X importtime,
+# and counts the modules imported.
+def importTime(args):
+   r=subprocess.run([sys.executable, "-X", "importtime"]+args,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                    stdin=subprocess.DEVNULL, text=True)
+   total=0
+   count=0
+   for line in r.stderr.splitlines():
+      if (line.startswith("import time:") and not line.endswith("package")):
+         fields=line.split("|")
+         total+=int(fields[0].split(":")[1])
+         count+=1
+   return (total, count)
+
+def benchStartup(runs):
+   here=os.path.dirname(os.path.abspath(__file__))
+   targets=[("python (baseline)", ["-c", "pass"]),
+            ("import fsm", ["-c", "import fsm"]),
+            ("import rle", ["-c", "import rle"]),
+            ("fsm-rle.py", [os.path.join(here, "fsm-rle.py")]),
+            ("urle.py", [os.path.join(here, "urle.py")]),
+            ("fsm-gen.py --help", [os.path.join(here, "fsm-gen.py"), "--help"])]
+   print(f"{'command':<20} {'wall ms':>8} {'import ms':>10} {'modules':>8}")
+   for name, args in targets:
+      walls=[]
+      for i in range(runs):
+         start=time.perf_counter()
+         subprocess.run([sys.executable]+args, stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL,
+                        cwd=here)
+         walls.append(time.perf_counter()-start)
+      walls.sort()
+      total, count=importTime(args)
+      print(f"{name:<20} {walls[runs//2]*1000:>8.1f} {total/1000:>10.1f} {count:>8}")
+
+def showSyntax():
+   print("FSM benchmarks")
+   print("Syntax: fsm-bench.py <benchmark> [options]")
+   print("   threads [maxThreads]   I/O-bound dispatch on 1..maxThreads (default 16)")
+   print("   dispatch [transitions] Transitions/s with and without guards, metrics (default 200000)")
+   print("   scheduler [long] [n]   Latency of n short machines next to one long one (default 1000000, 1000)")
+   print("   rle [MB] [maxJobs]     RLE encode/decode on 1..maxJobs processes (default 256 MB, CPU count)")
+   print("   startup [runs]         Spawn time and import cost of fsm and the tools (default 20 runs)")
+   return()
+
+def main():
+   if (argc<2):
+      showSyntax()
+      return
+
+   if (argv[1]=="threads"):
+      maxThreads=16
+      if (argc>2):
+         maxThreads=int(argv[2])
+      benchThreads(maxThreads)
+   elif (argv[1]=="dispatch"):
+      transitions=200000
+      if (argc>2):
+         transitions=int(argv[2])
+      benchDispatch(transitions)
+   elif (argv[1]=="scheduler"):
+      longTransitions=1000000
+      shortMachines=1000
+      if (argc>2):
+         longTransitions=int(argv[2])
+      if (argc>3):
+         shortMachines=int(argv[3])
+      benchScheduler(longTransitions, shortMachines)
+   elif (argv[1]=="rle"):
+      megabytes=256
+      maxJobs=os.cpu_count() or 1
+      if (argc>2):
+         megabytes=int(argv[2])
+      if (argc>3):
+         maxJobs=int(argv[3])
+      benchRLE(megabytes, maxJobs)
+   elif (argv[1]=="startup"):
+      runs=20
+      if (argc>2):
+         runs=int(argv[2])
+      benchStartup(runs)
+   else:
+      showSyntax()
+
+if __name__=="__main__":
+   main()
@@ -2,9 +2,10 @@
 
 # Code template generator for FSM library.
 # September 2021, Karim Sultan
-from fsm import *
+# The generator doesn't use the fsm module itself, and datetime is only
+# imported when a template is written, to keep startup fast.
 import os
-from datetime import datetime
+import sys
 
 # Generator Data
 # Most generator is declared in place, not in advance using
@@ -34,6 +35,8 @@ argc=(len(argv))
 '''
 
 states='''
+# Maps state names to state classes.  Alternate way to set the next
+# state, by name: context.setNextState(states["<name>"])
 states={}
 '''
 
@@ -47,7 +50,7 @@ def showSyntax():
 '''
 
 classState='''
-class State{}(State):
+class State{}(State):{}
    def __init__(self, stateName):
       super().__init__("{}")
 
@@ -55,27 +58,69 @@ class State{}(State):
       # TODO Replace with your logic
       print(f"Currently in {}")
 
-      # Set the next state based on triggers/transitions
+      # Set the next state based on triggers/transitions.
+      # States are named by class, which the dispatcher finds directly.
       context.setNextState({})
    
 # End of class State{}
 
 '''
 
+slots='''
+   # No per-instance dictionary; states only keep their name
+   __slots__=()
+'''
+
+bench='''
+# Micro-benchmark: runs the machine <runs> times with its output
+# discarded, and reports the rate.  Use "--bench [runs]".
+def bench(runs):
+   import os
+   import time
+   dispatcher=Dispatcher()
+   dispatcher.register({})
+   stdout=sys.stdout
+   sys.stdout=open(os.devnull, "w")
+   start=time.perf_counter()
+   try:
+      for i in range(runs):
+         context=Context("{}")
+         context.setNextState(State1)
+         dispatcher.dispatch(context)
+   finally:
+      sys.stdout.close()
+      sys.stdout=stdout
+   elapsed=time.perf_counter()-start
+   print(f"{{runs:,}} runs in {{elapsed:.3f}}s: {{runs/elapsed:,.0f}} runs/s, "
+         f"{{elapsed/runs*1e6:.1f}} us/run")
+
+'''
+
+benchMain='''
+   # Benchmark mode: --bench [runs]
+   if ("--bench" in sys.argv):
+      i=sys.argv.index("--bench")
+      runs=int(sys.argv[i+1]) if len(sys.argv)>i+1 else 10000
+      bench(runs)
+      return
+'''
+
 smain='''
-def main():
+def main():{}
    {}
-   
+
    # Only five steps are needed to run the FSM.
 
    # 1. Create our context
    context=Context("{}")
 
    # 2. Identify the first state to instantiate
-   context.setNextState("State1")
+   context.setNextState(State1)
 
-   # 3. Create our dispatcher
+   # 3. Create our dispatcher, and register our states with it.
+   #    Each state is created once and reused for every transition.
    dispatcher=Dispatcher()
+   dispatcher.register({})
 
    # 4. Dispatch! This executes the FSM
    dispatcher.dispatch(context)
@@ -192,7 +237,19 @@ def getInputs(responses):
    if responses["author"]=="": 
       responses["author"]="Unknown"
    print(f"Using author name of \"{responses['author']}\"")
-         
+
+   # Optional, __slots__ on the state classes
+   print()
+   responses["hasSlots"]=prompt("8. Declare __slots__ on the state classes?",
+                                ['y','n'], 'y', 'y')
+   print(f"Declare __slots__: {responses['hasSlots']}")
+
+   # Optional, built-in micro-benchmark
+   print()
+   responses["hasBench"]=prompt("9. Include a --bench flag (micro-benchmark)?",
+                                ['y','n'], 'y', 'y')
+   print(f"Include --bench: {responses['hasBench']}")
+
 # End of getInputs()
 
 def produceSummary(responses):
@@ -202,7 +259,7 @@ def produceSummary(responses):
 
    # Summary and confirm step
    report="\n"
-   report+="8. Summary\n"
+   report+="10. Summary\n"
    report+=f"App name: \"{responses['appName']}\" by \"{responses['author']}\"\n"
    report+=f"Writing to source file: \"{responses['outfile']}\"\n"
    report+=f"Generating {responses['numStates']} states.\n"
@@ -211,6 +268,8 @@ def produceSummary(responses):
          report+=f" {i+1:2}.  State{i+1}:   {responses['stateNames'][i]}\n"
    report+=f"Requires use of command line parameters: {responses['hasCLParameters']}\n"
    report+=f"Show usage syntax when no parameters: {responses['hasSyntax']}\n"
+   report+=f"Declare __slots__ on state classes: {responses['hasSlots']}\n"
+   report+=f"Include --bench micro-benchmark: {responses['hasBench']}\n"
    report+="\n"
    print(report, end='')
 
@@ -229,6 +288,8 @@ def produceSummary(responses):
 
 
 def generateTemplate(responses):
+   from datetime import datetime
+
    # Time to write
    outfile=open(responses["outfile"], "w+")
 
@@ -241,14 +302,9 @@ def generateTemplate(responses):
    if (responses["hasCLParameters"]):
       outfile.write(clparameters)
 
-   # Build statename dictionary (maps state name ==> class name)
-   # Alternate way to set next state, by name instead of class name
-   outfile.write(states)
-   fmt="states[\"{}\"] = {}"
-   for i in range(responses["numStates"]):
-      outfile.write(str.format(fmt, responses['stateNames'][i],
-                                    "\"State"+str(i+1)+"\"\n"))      
-   
+   # The benchmark needs sys even without command line parameters
+   elif (responses["hasBench"]):
+      outfile.write("import sys\n")
 
    # Write the showSyntax() function
    if (responses["hasSyntax"]):
@@ -257,18 +313,40 @@ def generateTemplate(responses):
                                        datetime.today().strftime('%B %d, %Y'),
                                        responses['outfile']))
 
-   # Write out generated state classes
+   # Write out generated state classes.  Next states are named by
+   # class rather than by string, so the dispatcher finds them with a
+   # direct lookup.
    for i in range(responses["numStates"]):      
       if (i==responses["numStates"]-1):
          ns="None"
       else:
-         ns=f"\"State{i+2}\""
+         ns=f"State{i+2}"
       outfile.write(str.format(classState, i+1,
+                                           slots if responses["hasSlots"] else "",
                                            responses['stateNames'][i],
                                            "{self.name}",
                                            ns,
                                            i+1))
 
+   # Build statename dictionary (maps state name ==> class)
+   # Alternate way to set next state, by name instead of class
+   outfile.write(states)
+   fmt="states[\"{}\"] = {}\n"
+   for i in range(responses["numStates"]):
+      outfile.write(str.format(fmt, responses['stateNames'][i],
+                                    "State"+str(i+1)))
+   outfile.write("\n")
+
+   # All state classes, for dispatcher.register()
+   classes=", ".join(f"State{i+1}" for i in range(responses["numStates"]))
+
+   # Write the benchmark
+   if (responses["hasBench"]):
+      outfile.write(str.format(bench, classes, responses['appName']))
+      b=benchMain
+   else:
+      b=""
+
    # Write out our generated main()
    if (responses['hasSyntax']):
       s='''
@@ -278,7 +356,7 @@ def generateTemplate(responses):
       return'''
    else:
       s=""
-   outfile.write(str.format(smain, s, responses['appName']))
+   outfile.write(str.format(smain, b, s, responses['appName'], classes))
 
    # Clean up
    outfile.close()
@@ -295,6 +373,9 @@ By Karim Sultan, September 2021.
 This utility will ask a few questions about your DFA / FSM and will generate
 a code template.  This is the interactive version.
 ''')
+   if (len(sys.argv)>1 and sys.argv[1] in ("-h", "--help")):
+      return
+
    responses = dict()
 
    # Get inputs
@@ -1,12 +1,15 @@
 #!/usr/bin/python3
 
 # This is a Run Length Encoded (RLE) FSM which accepts a file as input,
-# and outputs a run-length encoded file:
+# and outputs a run-length encoded file in the container format
+# described in rle.py:
 #
-# BYTE   BYTE
-# <run>  <byte>
+# HEADER  BLOCK...  INDEX  TRAILER
 #
-# So, 06 65 01 DE would represent 65 65 65 65 65 65 DE
+# Each block holds runs (<count> <byte>, count being a variable length
+# integer so there is no cap on run length) and literal spans for data
+# that doesn't repeat, plus a checksum.  The index lets urle.py seek to
+# any byte range without expanding the whole file.
 #
 # RLE is not very efficient.  It can be optimized better and works best
 # on files with repetitive data (such as raw graphics files).  But this
@@ -15,13 +18,26 @@
 # NOTE: See FSM diagram in the source code directory
 
 from fsm import Context, State, Dispatcher
-import io
+import collections
+import mmap
 import os
-import struct
+import rle
 import sys
+import zlib
 argv=sys.argv
 argc=(len(argv))
 
+# Byte pipeline: the input is mapped once (mmap) and each block is a
+# memoryview slice of it, so no input bytes are copied.  Blocks are
+# encoded into one preallocated output buffer which is reused for
+# every block.
+#
+# Parallel mode (--jobs=N): blocks are encoded by a ProcessPoolExecutor
+# instead.  Encoded blocks wait in a bounded reorder queue ("pending")
+# and are written strictly in order; memory is capped at "depth" blocks.
+# Blocks are encoded independently, so a run crossing a block boundary
+# simply becomes two runs and nothing needs stitching back together.
+
 class State0(State):
    # Call super in base class for constructor
    def __init__(self, stateName):
@@ -30,9 +46,35 @@ class State0(State):
    # Must override this to provide logic for state
    def run(self, context):
 
-      # Initialize
-      context.push("run", 0)
-      context.push("controlByte", -1)
+      # Map the input.  Empty files can't be mapped, so those (and
+      # anything mmap refuses) are read into a bytearray with readinto.
+      size=context.get("infileSize")
+      file=open(context.get("infile"), "rb")
+      try:
+         data=mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+      except (ValueError, OSError):
+         data=bytearray(size)
+         file.readinto(data)
+      file.close()
+      context.push("inData", data)
+      context.push("inView", memoryview(data))
+      context.push("inPos", 0)
+
+      # Open the container; this writes the header
+      file=open(context.get("outfile"), "wb")
+      context.push("outFile", file)
+      context.push("writer", rle.Writer(file, context.get("blockSize")))
+
+      # Reorder queue, and the worker pool in parallel mode.  In parallel
+      # mode the queue holds Futures, otherwise encoded blocks.
+      context.push("pending", collections.deque())
+      if (context.get("jobs")>1):
+         # Imported here; it is costly and only needed with --jobs
+         from concurrent.futures import ProcessPoolExecutor
+         context.push("pool", ProcessPoolExecutor(context.get("jobs")))
+         context.push("depth", 2*context.get("jobs"))
+      else:
+         context.push("depth", 1)
 
       # Next State:
       context.setNextState("State1")
@@ -41,34 +83,26 @@ class State0(State):
 class State1(State):
    # Call super in base class for constructor
    def __init__(self, stateName):
-      super().__init__("State1 - Read Char")
+      super().__init__("State1 - Read Block")
 
    # Override
    def run(self, context):
-      # Algorithm: Normally I would use a chunked read pattern,
-      # with an interim buffer, but this is just a demo and
-      # not meant for production so I will just it into memory
-      # and using a memory stream, read it byte by byte.
-
-      # If no memory stream then load file data into memory.
-      if (not context.exists("memStream")):
-         file=open(context.get("infile"), "rb")
-         data=file.read()
-         ms=io.BytesIO(data)
-         context.push("memStream", ms)
-      else:
-         # memory stream exists, so load it
-         ms=context.get("memStream")
+      view=context.get("inView")
+      pos=context.get("inPos")
 
-      if not eof(ms):
-         b=ms.read(1)
-         context.push("byte", b)
+      if pos < len(view):
+         # A block is a slice of the mapping; nothing is copied
+         end=min(pos+context.get("blockSize"), len(view))
+         context.push("block", view[pos:end])
+         context.push("blockPos", pos)
+         context.push("inPos", end)
 
          # Set the next state
          context.setNextState("State2")
+      elif context.get("pending"):
+         # Input done; drain the reorder queue
+         context.setNextState("State3")
       else:
-         # TODO: Set this to the EOF State. For now, exit
-         print("EOF.")
          context.setNextState("State4")
 
 # End of class State1
@@ -76,66 +110,51 @@ class State1(State):
 class State2(State):
    # Call super in base class for constructor
    def __init__(self, stateName):
-      super().__init__("State2 - Count Char")
+      super().__init__("State2 - Encode Block")
 
    # Override
    def run(self, context):
-      b=context.get("byte")
-
-      #if (context.get("run")==0):
-      if (context.get("outfileSize") <= 0 and context.get("run")==0):
-         # First byte.  Count it.
-         context.push("run", 1)
-
-         # Stash it
-         context.push("controlByte", b)
+      # Runs of any length become <count> <byte>; everything else is
+      # kept as literal spans (see rle.py)
+      block=context.get("block")
+      pending=context.get("pending")
+      if context.exists("pool"):
+         # Workers read the block from the file themselves
+         pending.append(context.get("pool").submit(rle.encodeAt,
+                                                   context.get("infile"),
+                                                   context.get("blockPos"),
+                                                   len(block)))
       else:
-         # Is this a repeat byte?
-         if (context.get("controlByte")==b):
-            context.push("run", context.get("run")+1)
-
-            # Next state is read char again
-            context.setNextState("State1")
-         else:
-            # New byte. Terminate current run.
-            x = context.get("run").to_bytes(1, "big")
-            c = context.get("controlByte")
-            rle = x + c
-            context.push("rle", rle)
-
-            # Reset counters
-            context.push("controlByte", b)
-            context.push("run", 1)
-
-            # Set next state -> Write Run to file
-            context.setNextState("State3")
-
-
-      # TODO: Check if we have 255 in counter and flush it
+         writer=context.get("writer")
+         n=rle.encodeBlock(block, writer.buffer)
+         pending.append((memoryview(writer.buffer)[:n], len(block), zlib.crc32(block)))
+      block.release()
+
+      # Set next state -> Write Block once the queue is full,
+      # otherwise keep reading
+      if (len(pending)>=context.get("depth")):
+         context.setNextState("State3")
+      else:
+         context.setNextState("State1")
 
 # End of class State2
 
 class State3(State):
    # Call super in base class for constructor
    def __init__(self, stateName):
-      super().__init__("State3 - Write Run")
+      super().__init__("State3 - Write Block")
 
    # Override
    def run(self, context):
-      # Ensure we have data to write
-      # Redundant / shouldn't happen / but this caught a nasty bug
-      # so I'm leaving it in.
-      if not context.exists("rle"):
-         context.setNextState("State1")
-
-      file=open(context.get("outfile"), "ab+")
-      rle=context.get("rle")
-      c=file.write(rle)
-      context.push("outfileSize", context.get("outfileSize")+c)
-      file.close()
+      # Write the oldest block; wait for it if it's still being encoded
+      head=context.get("pending").popleft()
+      if context.exists("pool"):
+         head=head.result()
+      payload, rawSize, crc=head
+      context.get("writer").writePayload(payload, rawSize, crc)
 
       # Next state
-      # Get next char
+      # Get next block
       context.setNextState("State1")
 
 # End of class State3
@@ -147,13 +166,23 @@ class State4(State):
 
    # Override
    def run(self, context):
-      # Do any clean up and exit
-      # Nothing to do - yet.
+      # Write the block index and trailer
+      writer=context.get("writer")
+      writer.close()
+      context.get("outFile").close()
+      ofs=writer.size
+      context.push("outfileSize", ofs)
+      if context.exists("pool"):
+         context.get("pool").shutdown()
+
+      # Release the view before closing the mapping
+      context.get("inView").release()
+      if isinstance(context.get("inData"), mmap.mmap):
+         context.get("inData").close()
 
       # TODO: Show statistics
-      ofs=context.get("outfileSize")
       ifs=context.get("infileSize")
-      pct=ofs/ifs*100
+      pct=ofs/ifs*100 if ifs else 100.0
 
       print(f"Initial size: {ifs:,} bytes.")
       print(f"Outfile size: {ofs:,} bytes.")
@@ -164,26 +193,28 @@ class State4(State):
 
 # End of class State4
 
-# Detects EOF.  Python should have this built in.
-def eof(f):
-   cur = f.tell()    # save current position
-   f.seek(0, os.SEEK_END)
-   end = f.tell()    # find the size of file
-   f.seek(cur, os.SEEK_SET)
-   return cur == end
-
 def showSyntax():
    print("Run Length Encoder Finite State Machine")
    print("This is a demo example of how to use the fsm module.")
-   print("Syntax: fsmrle <input file>")
+   print("Syntax: fsmrle <input file> [--jobs=N]")
    print("Will output to <file.rle> and overwrite any existing output.")
+   print("--jobs encodes blocks on N worker processes (default 1).")
    return()
 
 def doHouseKeeping(context):
-   if not os.path.isfile(argv[1]):
-      print (f"Invalid input file: {argv[1]}")
+   jobs=1
+   args=[]
+   for arg in argv[1:]:
+      if arg.startswith("--jobs="):
+         jobs=max(1, int(arg[len("--jobs="):]))
+      else:
+         args.append(arg)
+   context.push("jobs", jobs)
+
+   if not args or not os.path.isfile(args[0]):
+      print (f"Invalid input file: {args[0] if args else ''}")
       exit()
-   infile=argv[1]
+   infile=args[0]
    context.push("infile", infile)
    context.push("infileSize", os.path.getsize(infile))
 
@@ -191,6 +222,7 @@ def doHouseKeeping(context):
    outfile=infile+".rle"
    context.push("outfile", outfile)
    context.push("outfileSize", 0)
+   context.push("blockSize", rle.BLOCKSIZE)
    # overwrite it if it already exists
    if os.path.isfile(outfile):
       os.remove(outfile)
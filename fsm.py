@@ -8,7 +8,25 @@
 # in the context object, which is mainly just a hash map of
 # required data, as well as pointers to the current and next state.
 
-import inspect
+# Threading: a Context is safe to read from any thread without
+# locking.  Every read (get, exists, count, iteration) is a single
+# dictionary operation, which is atomic on the GIL build and is
+# guarded by the dictionary's own per-object lock on the free-threaded
+# (3.13t) build.  Compound read-modify-write updates should be wrapped
+# in "with context.lock:".  The ThreadedDispatcher holds that lock for
+# the whole run of a machine, so two workers never advance the same
+# context at once.  The lock (and the legacy iterator's thread-local) is
+# only created on first use, so single-threaded machines don't pay for it.
+
+# Imports are kept few so "import fsm" stays cheap; tools built on it
+# are often spawned from shell pipelines where startup dominates.
+import heapq
+import sys
+import threading
+import time
+
+# Guards the first-use creation of each Context's lock and thread-local
+_CREATE=threading.Lock()
 
 # The context is the state information passed between states.
 # It can contain file pointers, stream data, flags, operational status,
@@ -20,7 +38,8 @@ class Context():
       self.name = contextName
       self.__dict = dict()
       self.__nextState = None
-      self.__iterator = None      
+      self.__local = None
+      self.__lock = None
 
       # Decorators
       self.push=self.set
@@ -36,25 +55,41 @@ class Context():
    def __str__(self):
       return self.getAll()
 
-   # Iter() + next() implements iterative protocol.
-   # So one can do: for i in context
-   # __iter__ must return an iterative object
+   # Iter() implements iterative protocol.
+   # So one can do: for k, v in context
+   # Each call returns a fresh iterator over a snapshot of the (k,v)
+   # tuples, so concurrent loops (or writes) never disturb each other.
    def __iter__(self):
-      return self
-
-   # __next__ must return a value if available, or raise StopIteration
-   # we iterate through the dictionary keys, and return a (k,v) tuple.
+      return iter(list(self.__dict.items()))
+
+   # Per-context lock for compound updates and threaded dispatch,
+   # created on first use.
+   @property
+   def lock(self):
+      lock=self.__lock
+      if (lock==None):
+         with _CREATE:
+            if (self.__lock==None):
+               self.__lock=threading.RLock()
+            lock=self.__lock
+      return (lock)
+
+   # Legacy next(context) support.  The iterator state is kept per
+   # thread so two threads stepping the same context don't collide.
    def __next__(self):
-      if (self.__iterator==None):
-         self.__iterator=self.__dict.keys().__iter__()
-         t=()
+      local=self.__local
+      if (local==None):
+         with _CREATE:
+            if (self.__local==None):
+               self.__local=threading.local()
+            local=self.__local
+      if (getattr(local, "iterator", None)==None):
+         local.iterator=self.__iter__()
       try:
-         k=self.__iterator.__next__()
-         t=(k, self.__dict[k])
+         return (next(local.iterator))
       except StopIteration:
-         self._iterator = None
-         raise StopIteration
-      return (t)
+         local.iterator = None
+         raise
 
    def setNextState(self, className):
       if (className==""):
@@ -69,13 +104,10 @@ class Context():
       self.__dict[key]=value
 
    def get(self, key):
-      if (key in self.__dict.keys()):
-         return (self.__dict[key])
-      return (None)
+      return (self.__dict.get(key))
 
    def delete(self, key):
-      if self.exists(key):
-         del __dict[key]
+      self.__dict.pop(key, None)
 
    def clear(self):
       self.__dict=dict()
@@ -89,7 +121,7 @@ class Context():
 
       properties = []
       properties.append("{")
-      for key, value in self.__dict.items():
+      for key, value in list(self.__dict.items()):
          if (isinstance(value, int)):
             properties.append(f"   '{key}': {value},")
          else:
@@ -108,12 +140,8 @@ class Context():
    # Returns True if key exists and is not None; or for clarity,
    # returns False if no key, or if is key but value is None.
    def exists(self, key):
-      if (key in self.__dict.keys()):
-         if (not self.__dict[key]==None):
-            return True
-
-      # Key does not exist or is None
-      return False
+      # Single lookup; a missing key and a None value both read as None
+      return (not self.__dict.get(key)==None)
 
 # End of class Context
 
@@ -123,6 +151,10 @@ class Context():
 # derived from, and run() must be overridden.
 # NOTE: This is sample code.  Replace as required.
 class State():
+   # Derived states may declare __slots__ too, to drop the per-instance
+   # dictionary; states keep nothing but their name.
+   __slots__=("name",)
+
    def __init__(self, stateName):
       self.name = stateName;
 
@@ -143,33 +175,643 @@ class State():
 
 # End of class State
 
+# Memoizes a pure state: one whose context writes and next state depend
+# only on the values of a few context keys.  The first run() for a given
+# tuple of key values is recorded; later runs with the same values replay
+# the recorded writes and next state without calling run() at all.
+# Usage:
+#   @cached_state(keys=["email"], maxsize=1024)
+#   class ValidateEmail(State): ...
+#
+#   ValidateEmail.cache.info()        -> hits, misses, maxsize, size
+#   ValidateEmail.cache.invalidate(v) -> forget the entry for key values v
+#   ValidateEmail.cache.clear()       -> forget everything
+# Written values are copied into the cache and copied again on each
+# replay (immutable values are shared), so machines never share a
+# mutable object through it.  Runs that write a value which can't be
+# copied (a lock, file, socket...) are not cached.  A cached subclass of a cached state uses
+# only its own cache; the parent's is bypassed for its instances.
+def cached_state(keys, maxsize=128):
+   def decorate(klass):
+      cache=StateCache(keys, maxsize)
+      run=klass.run
+
+      def cachedRun(self, context):
+         if (type(self).cache is not cache):
+            # A subclass with a cache of its own
+            run(self, context)
+            return
+         cache.run(self, context, run)
+
+      klass.run=cachedRun
+      klass.cache=cache
+      return (klass)
+   return (decorate)
+
+# The LRU cache behind @cached_state.  Entries live in a plain dict, which
+# keeps insertion order: a hit moves its entry to the end, and eviction
+# drops the first (least recently used) entry.
+class StateCache():
+   def __init__(self, keys, maxsize=128):
+      self.keys=tuple(keys)
+      self.maxsize=maxsize
+      self.__entries=dict()
+      self.__lock=threading.Lock()
+      self.hits=0
+      self.misses=0
+
+   # Replays a cached result, or runs the state and records it.
+   def run(self, state, context, run):
+      key=tuple(context.get(k) for k in self.keys)
+      try:
+         hash(key)
+      except TypeError:
+         # Unhashable inputs can't be cached; just run the state
+         run(state, context)
+         return
+
+      with self.__lock:
+         entry=self.__entries.pop(key, None)
+         if (entry!=None):
+            self.__entries[key]=entry
+            self.hits+=1
+         else:
+            self.misses+=1
+
+      if (entry!=None):
+         writes, nextState=entry
+         for k, v in writes:
+            if (v is _DELETED):
+               context.delete(k)
+            else:
+               context.set(k, _copy(v))
+         context.setNextState(nextState)
+         return
+
+      recorder=_RecordingContext(context)
+      run(state, recorder)
+      if not recorder.cacheable:
+         return
+      try:
+         writes=tuple((k, v if v is _DELETED else _copy(v)) for k, v in recorder.writes)
+      except Exception:
+         # A value that can't be copied (a lock, file, socket...) can't
+         # be replayed either; the run stands, it just isn't cached
+         return
+      with self.__lock:
+         self.__entries[key]=(writes, context.getNextState())
+         if (len(self.__entries)>self.maxsize):
+            del self.__entries[next(iter(self.__entries))]
+
+   # Returns the cache statistics as a dictionary.
+   def info(self):
+      return ({"hits": self.hits, "misses": self.misses,
+               "maxsize": self.maxsize, "size": len(self.__entries)})
+
+   # Forgets the entry for the given key values (in the order of keys).
+   # Returns True if there was one.
+   def invalidate(self, *values):
+      with self.__lock:
+         return (self.__entries.pop(tuple(values), None)!=None)
+
+   def clear(self):
+      with self.__lock:
+         self.__entries.clear()
+         self.hits=0
+         self.misses=0
+
+# End of class StateCache
+
+# Marks a recorded delete()
+_DELETED=object()
+
+# Types whose values can be shared instead of copied
+_IMMUTABLE=(type(None), bool, int, float, complex, str, bytes, frozenset, range, type)
+
+# Returns value, or a deep copy if it (or anything in it) is mutable.
+def _copy(value):
+   if isinstance(value, _IMMUTABLE):
+      return (value)
+   if (type(value)==tuple and all(isinstance(v, _IMMUTABLE) for v in value)):
+      return (value)
+   import copy
+   return (copy.deepcopy(value))
+
+# Stands in for the context while a cached state runs for the first
+# time, recording every write.  All other calls go to the real context.
+class _RecordingContext():
+   def __init__(self, context):
+      self.context=context
+      self.writes=[]
+      self.cacheable=True
+
+   def __getattr__(self, name):
+      return (getattr(self.context, name))
+
+   def __len__(self):
+      return (len(self.context))
+
+   def __iter__(self):
+      return (iter(self.context))
+
+   def __str__(self):
+      return (str(self.context))
+
+   def set(self, key, value):
+      self.writes.append((key, value))
+      self.context.set(key, value)
+
+   push=set
+   put=set
+
+   def delete(self, key):
+      self.writes.append((key, _DELETED))
+      self.context.delete(key)
+
+   # A cleared context can't be replayed as a list of writes
+   def clear(self):
+      self.cacheable=False
+      self.context.clear()
+
+# End of class _RecordingContext
+
 # This class manages the states.
+# Optional guards stop a machine that never terminates:
+#   maxSteps       - most transitions a single dispatch may take
+#   maxTime        - most seconds (wall clock) a single dispatch may take,
+#                    checked before every step
+#   cycleKeys      - context keys that, with the current state, identify
+#                    where the machine is.  Every cycleInterval steps a
+#                    (state, values of those keys) snapshot is taken; seeing
+#                    the same snapshot twice means the machine is looping.
+#                    At most _Guard.maxSnapshots are kept; when full they
+#                    are forgotten and collection starts over, so loops
+#                    longer than half that many samples may go unnoticed.
+#   historySize    - transitions kept for the error report
+# A tripped guard raises a DispatchError subclass carrying the context,
+# the step count and the most recent transitions.  With no guards set the
+# dispatch loop is unchanged.
+#
+# Metrics: pass metrics=fsmmetrics.Metrics() to time every state's run()
+# and record it (see fsmmetrics.py).
+#
+# Registered states: dispatcher.register(State1, State2...) creates one
+# instance of each state up front and reuses it for every transition
+# (states are stateless).  A registered state can then be named by its
+# class, context.setNextState(State2), or by its class name, and is found
+# with a single dictionary lookup instead of through the caller's globals.
+# Unregistered states work as before.
 class Dispatcher:
+   def __init__(self, maxSteps=None, maxTime=None, cycleKeys=None,
+                cycleInterval=64, historySize=32, metrics=None):
+      self.registry=dict()
+      self.metrics=metrics
+      self.maxSteps=maxSteps
+      self.maxTime=maxTime
+      self.cycleKeys=None if cycleKeys==None else tuple(cycleKeys)
+      self.cycleInterval=cycleInterval
+      self.historySize=historySize
+
    # Initiates a state object (each state is stateless and
    # therefore are created/destroyed as required) and passes
    # the context information to it so it can process it.
    def dispatch(self, context):
-      # This line needs some explanation.
-      # We need the global table to find the state class definitions.
-      # However, those are in the calling module, which this module
-      # isn't aware of.  So how do we get them?  Well we could pass
-      # globals() in as a parameter, but better yet we can derive it
-      # from the Python stack using Inspect.  For the stack, [1] is
-      # the caller's stack, [0] is the caller's stack frame, and the
-      # callers globals are stored in a dictionary called "f_globals".
-      # see "inspect" @ https://docs.python.org/3/library/inspect.html
+      self._run(context, self._callerGlobals(context))
+      return
+
+   # Finds the global table holding the state class definitions.
+   # This needs some explanation.
+   # We need the global table to find the state class definitions.
+   # However, those are in the calling module, which this module
+   # isn't aware of.  So how do we get them?  Well we could pass
+   # globals() in as a parameter, but better yet we can derive it
+   # from the Python stack.  sys._getframe(depth) returns the frame
+   # <depth> calls up: [0] is this function, [1] our public method
+   # (dispatch, submit...) and [2] its caller, whose globals are
+   # stored in a dictionary called "f_globals".  Interpreters without
+   # _getframe fall back to inspect, which is slow to import and to
+   # walk, so it is only loaded on that path.
+   # see "inspect" @ https://docs.python.org/3/library/inspect.html
+   def _callerGlobals(self, context, depth=2):
       if context.exists("__NoCaller"):
-         caller_globals = globals()
-      else:
-         caller_globals = dict(inspect.getmembers(inspect.stack()[1][0]))["f_globals"]
-      while (context.getNextState()!=None):
-         klass = caller_globals[context.getNextState()]
-         s=klass(context.getNextState())
+         return (globals())
+      try:
+         frame=sys._getframe(depth)
+      except AttributeError:
+         import inspect
+         frame=inspect.stack()[depth][0]
+      return (frame.f_globals)
+
+   # Registers State classes, creating their single shared instances.
+   def register(self, *states):
+      for klass in states:
+         state=klass(klass.__name__)
+         self.registry[klass]=state
+         self.registry[klass.__name__]=state
+
+   # Runs the machine to completion using the given state table.
+   def _run(self, context, stateTable):
+      guard=self._newGuard()
+      registry=self.registry
+      metrics=self.metrics
+      try:
+         while (context.getNextState()!=None):
+            if (guard!=None):
+               guard.check(context)
+            s=registry.get(context.getNextState())
+            if (s==None):
+               s=self._newState(context.getNextState(), stateTable)
+            if (metrics==None):
+               s.run(context)
+            else:
+               self._timedRun(s, context)
+      finally:
+         # Terminated or failed, the machine is done with
+         if (metrics!=None):
+            metrics.finishContext(context)
+
+   # Runs a single transition.
+   def _step(self, context, stateTable):
+      s=self.registry.get(context.getNextState())
+      if (s==None):
+         s=self._newState(context.getNextState(), stateTable)
+      if (self.metrics==None):
          s.run(context)
-      return
+      else:
+         self._timedRun(s, context)
+
+   # Runs a state and records its latency.  The only metrics hook, used
+   # by dispatch() and the Scheduler alike.
+   def _timedRun(self, s, context):
+      state=context.getNextState()
+      start=time.perf_counter()
+      s.run(context)
+      self.metrics.observe(state, time.perf_counter()-start, context)
+
+   # Instantiates an unregistered state, named by class or class name.
+   def _newState(self, nextState, stateTable):
+      if isinstance(nextState, type):
+         return (nextState(nextState.__name__))
+      klass = stateTable[nextState]
+      return (klass(nextState))
+
+   # Returns a fresh guard for one machine, or None if no guards are set.
+   def _newGuard(self):
+      if (self.maxSteps==None and self.maxTime==None and self.cycleKeys==None):
+         return (None)
+      return (_Guard(self))
 
 # End of class Dispatcher
 
+# Raised when a dispatch guard trips.  history lists the most recent
+# states entered, oldest first, ending with the state about to run.
+class DispatchError(RuntimeError):
+   def __init__(self, message, context, steps, history):
+      super().__init__(f"{message} (context '{context.name}', {steps} steps, "
+                       f"recent states: {' -> '.join(_stateName(h) for h in history)})")
+      self.context=context
+      self.steps=steps
+      self.history=history
+
+# Next states may be class names or classes; reports use the name.
+def _stateName(state):
+   return (getattr(state, "__name__", str(state)))
+
+class StepLimitError(DispatchError):
+   pass
+
+class TimeLimitError(DispatchError):
+   pass
+
+class CycleError(DispatchError):
+   pass
+
+# Per-machine bookkeeping for the dispatch guards.  check() runs before
+# every transition, so it only records the state, counts and, with a time
+# limit, reads the clock (states may be slow, so the deadline can't wait
+# for a sample point).  The other limits are tested when the count
+# reaches nextCheck, which is the next sample point (every cycleInterval
+# steps) or the step limit, whichever is sooner.
+class _Guard():
+   # Most cycle snapshots held at once
+   maxSnapshots=4096
+
+   def __init__(self, dispatcher):
+      self.maxSteps=dispatcher.maxSteps
+      self.deadline=None
+      # Time left while the clock is paused
+      self.remaining=None
+      if (dispatcher.maxTime!=None):
+         self.deadline=time.monotonic()+dispatcher.maxTime
+      self.cycleKeys=dispatcher.cycleKeys
+      self.cycleInterval=max(1, dispatcher.cycleInterval)
+      self.snapshots=set()
+      self.steps=0
+      # Ring buffer of recent states
+      self.history=[None]*max(1, dispatcher.historySize)
+      self.nextCheck=self.cycleInterval
+      if (self.maxSteps!=None):
+         self.nextCheck=min(self.nextCheck, self.maxSteps+1)
+
+   # Called before each transition.
+   def check(self, context):
+      steps=self.steps
+      self.history[steps % len(self.history)]=context.getNextState()
+      self.steps=steps=steps+1
+      if (self.deadline!=None and time.monotonic()>self.deadline):
+         self.fail(TimeLimitError, "Exceeded the time limit", context)
+      if (steps>=self.nextCheck):
+         self.checkLimits(context)
+
+   def checkLimits(self, context):
+      steps=self.steps
+      if (self.maxSteps!=None and steps>self.maxSteps):
+         self.fail(StepLimitError, f"Exceeded {self.maxSteps} steps", context)
+      if (steps % self.cycleInterval==0 and self.cycleKeys!=None):
+         self.checkCycle(context)
+      self.nextCheck=steps+self.cycleInterval-(steps % self.cycleInterval)
+      if (self.maxSteps!=None):
+         self.nextCheck=min(self.nextCheck, self.maxSteps+1)
+
+   def checkCycle(self, context):
+      state=context.getNextState()
+      # The set compares hashes first and only then the values, so equal
+      # hashes of different values are not mistaken for a loop
+      snapshot=(state, tuple(context.get(k) for k in self.cycleKeys))
+      try:
+         seen=snapshot in self.snapshots
+      except TypeError:
+         # Unhashable values; skip this sample
+         return
+      if seen:
+         self.fail(CycleError, f"Cycle detected at state {_stateName(state)}", context)
+      if (len(self.snapshots)>=self.maxSnapshots):
+         self.snapshots.clear()
+      self.snapshots.add(snapshot)
+
+   # Stops and restarts the time limit's clock, so a machine run in
+   # slices (by the Scheduler) is only charged for its own time.
+   def pause(self):
+      if (self.deadline!=None):
+         self.remaining=self.deadline-time.monotonic()
+         self.deadline=None
+
+   def resume(self):
+      if (self.remaining!=None):
+         self.deadline=time.monotonic()+self.remaining
+         self.remaining=None
+
+   def recent(self):
+      n=len(self.history)
+      if (self.steps<=n):
+         return (self.history[:self.steps])
+      i=self.steps % n
+      return (self.history[i:]+self.history[:i])
+
+   def fail(self, error, message, context):
+      raise error(message, context, self.steps, self.recent())
+
+# End of class _Guard
+
+# Runs many machines at once on a pool of worker threads.  This suits
+# I/O-heavy states (sockets, files, subprocesses) where the GIL is
+# released while waiting; on the free-threaded build CPU-bound states
+# scale as well.  Each machine runs under its context's lock, so the
+# same context is never advanced by two workers at once.
+# Usage:
+#   with ThreadedDispatcher(8) as dispatcher:
+#      dispatcher.dispatchAll(contexts)
+class ThreadedDispatcher(Dispatcher):
+   # Guards (maxSteps=, maxTime=...) are passed on to Dispatcher and
+   # apply to each machine separately.
+   def __init__(self, maxWorkers=None, **guards):
+      super().__init__(**guards)
+      from concurrent.futures import ThreadPoolExecutor
+      self.executor=ThreadPoolExecutor(max_workers=maxWorkers,
+                                       thread_name_prefix="fsm")
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, excType, excValue, traceback):
+      self.shutdown()
+      return False
+
+   # Schedules one machine and returns its Future (result is the context).
+   def submit(self, context):
+      return (self.executor.submit(self._work, context,
+                                   self._callerGlobals(context)))
+
+   # Runs every machine and waits for them all.  Returns the contexts in
+   # the order given; the first exception raised by a state is re-raised.
+   def dispatchAll(self, contexts):
+      futures=[]
+      for c in contexts:
+         futures.append(self.executor.submit(self._work, c,
+                                             self._callerGlobals(c)))
+      return ([f.result() for f in futures])
+
+   def shutdown(self, wait=True):
+      self.executor.shutdown(wait=wait)
+
+   def _run(self, context, stateTable):
+      with context.lock:
+         super()._run(context, stateTable)
+
+   def _work(self, context, stateTable):
+      self._run(context, stateTable)
+      return (context)
+
+# End of class ThreadedDispatcher
+
+# Runs many machines fairly in one thread, without threads or asyncio.
+# Each machine (one Context) is advanced by at most <quantum> transitions
+# per turn, so a long-running machine can't hold up short ones.
+#   policy="roundrobin" - machines take turns in the order they were added
+#   policy="priority"   - the ready machine with the lowest priority value
+#                         always goes first; equal priorities take turns
+# A state can park its machine with scheduler.sleep(context, seconds) or
+# scheduler.waitUntil(context, condition); the machine keeps its next
+# state and resumes once the time passes or condition(context) is true.
+# States reach the scheduler through the reserved context key
+# "__Scheduler".  The dispatcher's guards (maxSteps...) apply per machine;
+# maxTime counts only the time the machine spends running.
+# A finished machine is forgotten; its step count is left on the context
+# under "__Steps".
+# Usage:
+#   scheduler=Scheduler(quantum=16)
+#   for context in contexts:
+#      scheduler.add(context)
+#   scheduler.run()
+class Scheduler():
+   def __init__(self, dispatcher=None, quantum=16, policy="roundrobin",
+                pollInterval=0.01):
+      if (policy not in ("roundrobin", "priority")):
+         raise ValueError(f"Unknown scheduling policy '{policy}'")
+      self.dispatcher=Dispatcher() if dispatcher==None else dispatcher
+      self.quantum=quantum
+      self.policy=policy
+      self.pollInterval=pollInterval
+      self.machines=dict()
+      self.__ready=[]
+      self.__sleeping=[]
+      self.__waiting=[]
+      self.__seq=0
+
+   # Adds a machine.  State classes are looked up in the caller's module,
+   # as with Dispatcher.dispatch().
+   def add(self, context, priority=0):
+      guard=self.dispatcher._newGuard()
+      if (guard!=None):
+         # maxTime counts only the machine's quanta, not its time queued,
+         # sleeping or waiting
+         guard.pause()
+      machine=_Machine(context, self.dispatcher._callerGlobals(context),
+                       priority, guard)
+      self.machines[context]=machine
+      context.set("__Scheduler", self)
+      self.__makeReady(machine)
+
+   # Parks the machine until <seconds> have passed.
+   def sleep(self, context, seconds):
+      self.machines[context].wakeAt=time.monotonic()+seconds
+
+   # Parks the machine until condition(context) returns True.
+   def waitUntil(self, context, condition):
+      self.machines[context].condition=condition
+
+   # Transitions taken by the machine so far, or in all if it finished.
+   def steps(self, context):
+      machine=self.machines.get(context)
+      if (machine==None):
+         return (context.get("__Steps"))
+      return (machine.steps)
+
+   # Machines that have not terminated yet.
+   def pending(self):
+      return (len(self.__ready)+len(self.__sleeping)+len(self.__waiting))
+
+   # Runs until every machine has terminated.
+   def run(self):
+      while (self.pending()>0):
+         if not self.runOnce():
+            # Nothing ready: wait for the next sleeper, polling the
+            # waiting machines' conditions meanwhile
+            delay=self.pollInterval
+            if self.__sleeping:
+               delay=self.__sleeping[0][0]-time.monotonic()
+               if self.__waiting:
+                  delay=min(delay, self.pollInterval)
+            if (delay>0):
+               time.sleep(delay)
+
+   # Gives every ready machine one quantum.  Returns False if no machine
+   # was ready.
+   def runOnce(self):
+      self.__wake()
+      turns=len(self.__ready)
+      for i in range(turns):
+         _, _, machine=heapq.heappop(self.__ready)
+         try:
+            self.__runQuantum(machine)
+         except BaseException:
+            # The machine is dead; drop it and let the error out
+            self.__finish(machine)
+            raise
+         self.__park(machine)
+      return (turns>0)
+
+   def __runQuantum(self, machine):
+      context=machine.context
+      stateTable=machine.stateTable
+      guard=machine.guard
+      step=self.dispatcher._step
+      if (guard!=None):
+         guard.resume()
+      try:
+         for i in range(self.quantum):
+            if (context.getNextState()==None):
+               return
+            if (guard!=None):
+               guard.check(context)
+            step(context, stateTable)
+            machine.steps+=1
+            if (machine.wakeAt!=None or machine.condition!=None):
+               return
+      finally:
+         if (guard!=None):
+            guard.pause()
+
+   # Requeues the machine after its quantum, as ready, sleeping,
+   # waiting or finished.
+   def __park(self, machine):
+      if (machine.context.getNextState()==None):
+         self.__finish(machine)
+      elif (machine.wakeAt!=None):
+         self.__seq+=1
+         heapq.heappush(self.__sleeping, (machine.wakeAt, self.__seq, machine))
+      elif (machine.condition!=None):
+         self.__waiting.append(machine)
+      else:
+         self.__makeReady(machine)
+
+   # Moves sleepers whose time has come, and waiters whose condition
+   # holds, to the ready queue.
+   def __wake(self):
+      now=time.monotonic()
+      while (self.__sleeping and self.__sleeping[0][0]<=now):
+         _, _, machine=heapq.heappop(self.__sleeping)
+         machine.wakeAt=None
+         self.__makeReady(machine)
+      if self.__waiting:
+         waiting=self.__waiting
+         self.__waiting=[]
+         for i, machine in enumerate(waiting):
+            try:
+               ready=machine.condition(machine.context)
+            except BaseException:
+               # Drop the machine whose condition failed, keep the rest
+               # waiting, and let the error out
+               self.__waiting.extend(waiting[i+1:])
+               self.__finish(machine)
+               raise
+            if ready:
+               machine.condition=None
+               self.__makeReady(machine)
+            else:
+               self.__waiting.append(machine)
+
+   # Forgets a machine that terminated or failed.
+   def __finish(self, machine):
+      context=machine.context
+      context.delete("__Scheduler")
+      context.set("__Steps", machine.steps)
+      self.machines.pop(context, None)
+      if (self.dispatcher.metrics!=None):
+         self.dispatcher.metrics.finishContext(context)
+
+   # The ready queue is a heap of (priority, sequence, machine); under
+   # round robin every priority is 0, so it is first in, first out.
+   def __makeReady(self, machine):
+      self.__seq+=1
+      priority=machine.priority if self.policy=="priority" else 0
+      heapq.heappush(self.__ready, (priority, self.__seq, machine))
+
+# End of class Scheduler
+
+# A machine held by the Scheduler.
+class _Machine():
+   def __init__(self, context, stateTable, priority, guard):
+      self.context=context
+      self.stateTable=stateTable
+      self.priority=priority
+      self.guard=guard
+      self.steps=0
+      self.wakeAt=None
+      self.condition=None
+
+# End of class _Machine
+
 # Demo test code
 def fsm_main():
    context=Context("FSM")
@@ -0,0 +1,298 @@
+# Metrics for FSM workers, exported in Prometheus text format.
+# October 2026.
+#
+# Hook a Metrics registry into a dispatcher and publish it through one
+# or more sinks:
+#
+#   metrics=Metrics()
+#   dispatcher=Dispatcher(metrics=metrics)
+#   metrics.addSink(FileSink("/var/lib/node_exporter/fsm.prom"))
+#   metrics.addSink(HTTPSink(metrics, port=9464))   # GET /metrics
+#   ...
+#   metrics.publish()
+#
+# Recorded per transition: a counter and a fixed-bucket latency histogram
+# per state, and the overall transition count.  Every sampleInterval
+# transitions a running context's key count and approximate size in
+# bytes are sampled; when the machine terminates it is measured once
+# more and forgotten.  Contexts are not labelled by name (names are often
+# per record), so the context gauges are aggregates.  Exported:
+#
+#   fsm_transitions_total                 counter
+#   fsm_transitions_per_second            gauge, over the last rateWindow+
+#                                         seconds between exports
+#   fsm_state_transitions_total{state}    counter
+#   fsm_state_seconds{state}              histogram
+#   fsm_contexts_live                     gauge, running contexts sampled
+#   fsm_context_keys_max                  gauge, over running contexts
+#   fsm_context_bytes_max                 gauge, over running contexts
+#   fsm_context_bytes_sum                 gauge, over running contexts
+#   fsm_context_bytes_peak                gauge, largest context ever seen
+#   fsm_contexts_finished_total           counter
+#
+# Recording takes no locks: every thread writes to its own shard, found
+# through a thread-local, and export() adds the shards together.  The
+# shard of a thread that has exited is folded into a retired shard, so
+# short-lived pool threads don't pile up.  The histogram for a state is a
+# list preallocated on its first transition.  A sink is any object with a
+# publish(metrics) method.
+
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+         0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metrics():
+   def __init__(self, buckets=BUCKETS, sampleInterval=64, rateWindow=1.0):
+      self.buckets=tuple(sorted(buckets))
+      self.sampleInterval=max(1, sampleInterval)
+      self.rateWindow=rateWindow
+      self.sinks=[]
+      self.__local=threading.local()
+      # (thread, shard) for every thread that has recorded
+      self.__shards=[]
+      # Totals of the threads that have exited
+      self.__retired=_Shard()
+      # Only taken when a thread records for the first time, or exports
+      self.__lock=threading.Lock()
+      # (time, transitions) at the start of the current rate window, and
+      # the rate over the previous window
+      self.__window=(time.monotonic(), 0)
+      self.__rate=None
+
+   def addSink(self, sink):
+      self.sinks.append(sink)
+
+   # Records one transition: the state that ran (a class or class name)
+   # and how long it took.  This is on the dispatch hot path.
+   def observe(self, state, seconds, context):
+      try:
+         shard=self.__local.shard
+      except AttributeError:
+         shard=self.__shard()
+      shard.transitions+=1
+      stats=shard.states.get(state)
+      if (stats==None):
+         # [count, sum, bucket 0, bucket 1, ..., +Inf]
+         stats=[0, 0.0]+[0]*(len(self.buckets)+1)
+         shard.states[state]=stats
+      stats[0]+=1
+      stats[1]+=seconds
+      stats[2+bisect_left(self.buckets, seconds)]+=1
+      if (shard.transitions % self.sampleInterval==0):
+         self.observeContext(context)
+
+   # Samples a running context's key count and approximate size.
+   def observeContext(self, context):
+      keys, size=measure(context)
+      shard=self.__shard()
+      shard.contexts[id(context)]=(keys, size)
+      shard.peak=max(shard.peak, size)
+
+   # Measures a machine that has terminated, and forgets it.
+   def finishContext(self, context):
+      keys, size=measure(context)
+      shard=self.__shard()
+      shard.contexts.pop(id(context), None)
+      shard.peak=max(shard.peak, size)
+      shard.finished+=1
+
+   # Returns every metric in Prometheus text exposition format.
+   def export(self):
+      with self.__lock:
+         self.__reap()
+         shards=[self.__retired]+[shard for thread, shard in self.__shards]
+         transitions=0
+         finished=0
+         peak=0
+         states=dict()
+         contexts=[]
+         for shard in shards:
+            transitions+=shard.transitions
+            finished+=shard.finished
+            peak=max(peak, shard.peak)
+            for state, stats in list(shard.states.items()):
+               # States are recorded as classes or names; report the name
+               state=getattr(state, "__name__", state)
+               total=states.setdefault(state, [0]*len(stats))
+               for i in range(len(stats)):
+                  total[i]+=stats[i]
+            contexts+=list(shard.contexts.values())
+
+      # The window only moves on once rateWindow seconds have passed, so
+      # several sinks exporting back to back still see a sensible rate
+      now=time.monotonic()
+      with self.__lock:
+         then, before=self.__window
+         if (now-then>=self.rateWindow or self.__rate==None):
+            self.__rate=(transitions-before)/(now-then) if now>then else 0.0
+            if (now-then>=self.rateWindow):
+               self.__window=(now, transitions)
+         rate=self.__rate
+
+      lines=[]
+      lines.append("# HELP fsm_transitions_total State transitions dispatched.")
+      lines.append("# TYPE fsm_transitions_total counter")
+      lines.append(f"fsm_transitions_total {transitions}")
+      lines.append("# HELP fsm_transitions_per_second Recent transition rate.")
+      lines.append("# TYPE fsm_transitions_per_second gauge")
+      lines.append(f"fsm_transitions_per_second {rate:.3f}")
+
+      lines.append("# HELP fsm_state_transitions_total Transitions into each state.")
+      lines.append("# TYPE fsm_state_transitions_total counter")
+      for state, stats in states.items():
+         lines.append(f'fsm_state_transitions_total{{state="{label(state)}"}} {stats[0]}')
+
+      lines.append("# HELP fsm_state_seconds Time spent in each state's run().")
+      lines.append("# TYPE fsm_state_seconds histogram")
+      for state, stats in states.items():
+         name=label(state)
+         cumulative=0
+         for i, bound in enumerate(self.buckets):
+            cumulative+=stats[2+i]
+            lines.append(f'fsm_state_seconds_bucket{{state="{name}",le="{bound}"}} {cumulative}')
+         lines.append(f'fsm_state_seconds_bucket{{state="{name}",le="+Inf"}} {stats[0]}')
+         lines.append(f'fsm_state_seconds_sum{{state="{name}"}} {stats[1]}')
+         lines.append(f'fsm_state_seconds_count{{state="{name}"}} {stats[0]}')
+
+      lines.append("# HELP fsm_contexts_live Running contexts that have been sampled.")
+      lines.append("# TYPE fsm_contexts_live gauge")
+      lines.append(f"fsm_contexts_live {len(contexts)}")
+      lines.append("# HELP fsm_context_keys_max Most keys held by a running context.")
+      lines.append("# TYPE fsm_context_keys_max gauge")
+      lines.append(f"fsm_context_keys_max {max((k for k, b in contexts), default=0)}")
+      lines.append("# HELP fsm_context_bytes_max Approximate size of the largest running context in bytes.")
+      lines.append("# TYPE fsm_context_bytes_max gauge")
+      lines.append(f"fsm_context_bytes_max {max((b for k, b in contexts), default=0)}")
+      lines.append("# HELP fsm_context_bytes_sum Approximate size of all running contexts in bytes.")
+      lines.append("# TYPE fsm_context_bytes_sum gauge")
+      lines.append(f"fsm_context_bytes_sum {sum(b for k, b in contexts)}")
+      lines.append("# HELP fsm_context_bytes_peak Approximate size of the largest context seen in bytes.")
+      lines.append("# TYPE fsm_context_bytes_peak gauge")
+      lines.append(f"fsm_context_bytes_peak {peak}")
+      lines.append("# HELP fsm_contexts_finished_total Machines that have terminated.")
+      lines.append("# TYPE fsm_contexts_finished_total counter")
+      lines.append(f"fsm_contexts_finished_total {finished}")
+      return ("\n".join(lines)+"\n")
+
+   # Hands the metrics to every sink.
+   def publish(self):
+      for sink in self.sinks:
+         sink.publish(self)
+
+   # This thread's shard, created on first use.
+   def __shard(self):
+      shard=getattr(self.__local, "shard", None)
+      if (shard==None):
+         shard=_Shard()
+         self.__local.shard=shard
+         with self.__lock:
+            self.__reap()
+            self.__shards.append((threading.current_thread(), shard))
+      return (shard)
+
+   # Folds the shards of exited threads into the retired shard.  Their
+   # running contexts died with them.  Called with the lock held.
+   def __reap(self):
+      live=[]
+      for thread, shard in self.__shards:
+         if thread.is_alive():
+            live.append((thread, shard))
+         else:
+            self.__retired.add(shard)
+      self.__shards=live
+
+# End of class Metrics
+
+# One thread's counters.  Only its own thread writes to it (the retired
+# shard is only touched under the registry's lock).
+class _Shard():
+   def __init__(self):
+      self.transitions=0
+      self.states=dict()
+      # id(context) -> (keys, bytes) for running contexts
+      self.contexts=dict()
+      self.finished=0
+      self.peak=0
+
+   # Adds another shard's counters to this one.
+   def add(self, other):
+      self.transitions+=other.transitions
+      self.finished+=other.finished
+      self.peak=max(self.peak, other.peak)
+      for state, stats in other.states.items():
+         total=self.states.setdefault(state, [0]*len(stats))
+         for i in range(len(stats)):
+            total[i]+=stats[i]
+
+# Returns a context's key count and approximate size in bytes.
+def measure(context):
+   size=sys.getsizeof(context)
+   for key, value in context:
+      size+=sys.getsizeof(key)+sys.getsizeof(value)
+   return ((len(context), size))
+
+# Escapes a Prometheus label value.
+def label(value):
+   value=str(value)
+   return (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+
+### Sinks ###
+
+# Writes the metrics to a file on each publish(), replacing it atomically
+# so a reader (e.g. node_exporter's textfile collector) never sees half
+# a file.
+class FileSink():
+   def __init__(self, path):
+      self.path=path
+
+   def publish(self, metrics):
+      temp=self.path+".tmp"
+      file=open(temp, "w")
+      file.write(metrics.export())
+      file.close()
+      os.replace(temp, self.path)
+
+# End of class FileSink
+
+# Serves the metrics at http://<host>:<port>/metrics from a background
+# thread.  Exports are made when scraped, so publish() does nothing.
+# port=0 picks a free port; see self.port.
+class HTTPSink():
+   def __init__(self, metrics, port=9464, host="127.0.0.1"):
+      from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+      class Handler(BaseHTTPRequestHandler):
+         def do_GET(self):
+            if (self.path.split("?")[0]!="/metrics"):
+               self.send_error(404)
+               return
+            body=metrics.export().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+         # Keep scrapes out of the worker's output
+         def log_message(self, format, *args):
+            pass
+
+      self.server=ThreadingHTTPServer((host, port), Handler)
+      self.server.daemon_threads=True
+      self.port=self.server.server_address[1]
+      threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+   def publish(self, metrics):
+      pass
+
+   def close(self):
+      self.server.shutdown()
+      self.server.server_close()
+
+# End of class HTTPSink
@@ -0,0 +1,319 @@
+# RLE container format, shared by fsm-rle.py (encode) and urle.py (decode).
+# October 2026.
+#
+# Layout (all integers little-endian):
+#
+#   Header   "FRLE" <version:u8> <flags:u8> <reserved:u16> <blockSize:u32>
+#   Block*   <payloadSize:u32> <rawSize:u32> <crc32(raw):u32> <payload>
+#   Index    <blockOffset:u64> per block (file offset of the block header)
+#   Trailer  <indexOffset:u64> <rawSize:u64> <blockCount:u32> "FIDX"
+#
+# Every block but the last holds exactly blockSize raw bytes, so the
+# block holding any raw offset is offset//blockSize.  Blocks are encoded
+# independently (runs are split at block boundaries) which lets a reader
+# seek to a byte range, or decode blocks in parallel, using the index.
+#
+# A payload is a sequence of tokens.  Each starts with a varint (LEB128)
+# header h; the low bit is the kind and h>>1 is the length:
+#
+#   kind 0 - run:      <h> <byte>           length copies of byte
+#   kind 1 - literal:  <h> <length bytes>   stored as is
+#
+# Runs shorter than MINRUN are cheaper as literals, so incompressible
+# data grows by only a few bytes per block instead of doubling.
+#
+# Files that do not start with the header are legacy <run:u8> <byte>
+# pair streams, as written by earlier versions of fsm-rle.py.  A file
+# that starts with the magic is a container, and one whose header,
+# trailer or index don't check out is damaged (a truncated download, say)
+# and raises RLEError.  A legacy file can start with the magic too (runs
+# of 70 'R' and 76 'E'); urle.py --legacy decodes those.
+#
+# Parallel use: encodeAt() and decodeAt() work from a file path and
+# offset, so a ProcessPoolExecutor only ships small task tuples to its
+# workers and gets encoded/decoded blocks back.  orderedMap() keeps at
+# most <depth> blocks in flight and yields them in file order.
+
+# re and collections are imported where they are used, so decoding
+# (urle.py) doesn't pay for them at startup.
+import struct
+import zlib
+
+MAGIC=b"FRLE"
+INDEXMAGIC=b"FIDX"
+VERSION=1
+BLOCKSIZE=1024*1024
+MINRUN=3
+
+HEADER=struct.Struct("<4sBBHI")
+BLOCKHEADER=struct.Struct("<III")
+INDEXENTRY=struct.Struct("<Q")
+TRAILER=struct.Struct("<QQI4s")
+
+RUNKIND=0
+LITERALKIND=1
+
+# Any byte repeated at least MINRUN times; compiled on first use
+RUNPATTERN=None
+
+class RLEError(Exception):
+   pass
+
+# Largest payload a block of n raw bytes can encode to.  The worst case
+# is a one byte literal between runs of MINRUN, which costs 2 bytes per
+# raw byte; the rest is slack for long varints.
+def maxPayload(n):
+   return (2*n+16)
+
+# Writes x as a varint at out[o]; returns the new offset.
+def putVarint(out, o, x):
+   while (x>=0x80):
+      out[o]=(x & 0x7F) | 0x80
+      x>>=7
+      o+=1
+   out[o]=x
+   return (o+1)
+
+# Reads a varint at data[o]; returns (value, new offset).  Varints longer
+# than 64 bits, or cut off by the end of data, raise RLEError.
+def getVarint(data, o):
+   x=0
+   shift=0
+   while True:
+      if (o>=len(data) or shift>63):
+         raise RLEError("Truncated or overlong varint")
+      b=data[o]
+      o+=1
+      x|=(b & 0x7F) << shift
+      if (b<0x80):
+         return (x, o)
+      shift+=7
+
+# Encodes raw bytes (any buffer) into out, a preallocated buffer of at
+# least maxPayload(len(src)) bytes.  Returns the payload size.
+def encodeBlock(src, out):
+   global RUNPATTERN
+   if (RUNPATTERN==None):
+      import re
+      RUNPATTERN=re.compile(rb"(.)\1{%d,}" % (MINRUN-1), re.DOTALL)
+   src=memoryview(src)
+   o=0
+   literal=0
+   for m in RUNPATTERN.finditer(src):
+      start, end=m.span()
+      if (start>literal):
+         o=putVarint(out, o, ((start-literal) << 1) | LITERALKIND)
+         out[o:o+start-literal]=src[literal:start]
+         o+=start-literal
+      o=putVarint(out, o, ((end-start) << 1) | RUNKIND)
+      out[o]=src[start]
+      o+=1
+      literal=end
+   if (len(src)>literal):
+      o=putVarint(out, o, ((len(src)-literal) << 1) | LITERALKIND)
+      out[o:o+len(src)-literal]=src[literal:]
+      o+=len(src)-literal
+   return (o)
+
+# Decodes a payload into out, a writable buffer of exactly the block's
+# raw size.  A damaged payload raises RLEError.
+def decodeBlock(payload, out):
+   payload=memoryview(payload)
+   out=memoryview(out)
+   i=0
+   o=0
+   while (i<len(payload)):
+      h, i=getVarint(payload, i)
+      n=h >> 1
+      if (o+n>len(out)):
+         raise RLEError("Block expands past its raw size")
+      if (h & 1==LITERALKIND):
+         if (i+n>len(payload)):
+            raise RLEError("Literal runs past the end of the block")
+         out[o:o+n]=payload[i:i+n]
+         i+=n
+      else:
+         if (i>=len(payload) or n==0):
+            raise RLEError("Damaged run in block")
+         # Fill by doubling: each copy is a non-overlapping memmove
+         out[o]=payload[i]
+         i+=1
+         k=1
+         while (k<n):
+            c=min(k, n-k)
+            out[o+k:o+k+c]=out[o:o+c]
+            k+=c
+      o+=n
+   if (o!=len(out)):
+      raise RLEError("Block is shorter than its raw size")
+
+### Writing ###
+
+# Writes a container, one block at a time.  Usage:
+#   w=Writer(file); w.writeBlock(data)...; w.close()
+class Writer():
+   def __init__(self, file, blockSize=BLOCKSIZE):
+      self.file=file
+      self.blockSize=blockSize
+      self.offsets=[]
+      self.rawSize=0
+      self.size=HEADER.size
+      self.buffer=bytearray(maxPayload(blockSize))
+      file.write(HEADER.pack(MAGIC, VERSION, 0, 0, blockSize))
+
+   # Encodes and writes one block of raw data (at most blockSize bytes).
+   def writeBlock(self, data):
+      n=encodeBlock(data, self.buffer)
+      self.writePayload(memoryview(self.buffer)[:n], len(data), zlib.crc32(data))
+
+   # Writes an already encoded block.
+   def writePayload(self, payload, rawSize, crc):
+      self.offsets.append(self.size)
+      self.file.write(BLOCKHEADER.pack(len(payload), rawSize, crc))
+      self.file.write(payload)
+      self.size+=BLOCKHEADER.size+len(payload)
+      self.rawSize+=rawSize
+
+   # Writes the index and trailer.  Does not close the file.
+   def close(self):
+      indexOffset=self.size
+      for offset in self.offsets:
+         self.file.write(INDEXENTRY.pack(offset))
+      self.file.write(TRAILER.pack(indexOffset, self.rawSize,
+                                   len(self.offsets), INDEXMAGIC))
+      self.size+=INDEXENTRY.size*len(self.offsets)+TRAILER.size
+
+# Worker: encodes raw bytes [offset, offset+length) of the file at path.
+# Returns (payload, rawSize, crc).
+def encodeAt(path, offset, length):
+   data=bytearray(length)
+   file=open(path, "rb")
+   file.seek(offset)
+   n=file.readinto(data)
+   file.close()
+   if (n!=length):
+      raise RLEError(f"Short read at offset {offset} of {path}")
+   out=bytearray(maxPayload(length))
+   size=encodeBlock(data, out)
+   del out[size:]
+   return (bytes(out), length, zlib.crc32(data))
+
+### Reading ###
+
+# True if the open binary file starts with the container magic.  Use
+# Reader to check the rest of it.
+def isContainer(file):
+   file.seek(0)
+   magic=file.read(len(MAGIC))
+   file.seek(0)
+   return (magic==MAGIC)
+
+# Random access reader over an open binary file.  Usage:
+#   r=Reader(file); data=r.read(start, length)
+# Payloads are read into one reused buffer, grown to the largest block.
+class Reader():
+   def __init__(self, file):
+      self.file=file
+      size=file.seek(0, 2)
+      if (size<HEADER.size+TRAILER.size):
+         raise RLEError("File is too short to be an RLE container")
+      file.seek(0)
+      magic, version, flags, _, self.blockSize=HEADER.unpack(file.read(HEADER.size))
+      if (magic!=MAGIC):
+         raise RLEError("Not an RLE container")
+      if (version!=VERSION):
+         raise RLEError(f"Unsupported RLE container version {version}")
+      if (self.blockSize==0):
+         raise RLEError("RLE container has a block size of 0")
+
+      file.seek(-TRAILER.size, 2)
+      indexOffset, self.rawSize, count, magic=TRAILER.unpack(file.read(TRAILER.size))
+      if (magic!=INDEXMAGIC):
+         raise RLEError("RLE container has no index (truncated file?)")
+      if (indexOffset+INDEXENTRY.size*count+TRAILER.size!=size):
+         raise RLEError("RLE container index does not match the file size")
+      self.indexOffset=indexOffset
+      self.buffer=bytearray()
+      file.seek(indexOffset)
+      index=file.read(INDEXENTRY.size*count)
+      self.offsets=[o for (o,) in INDEXENTRY.iter_unpack(index)]
+      for offset in self.offsets:
+         if (offset<HEADER.size or offset+BLOCKHEADER.size>indexOffset):
+            raise RLEError("RLE container index points outside the blocks")
+
+   def blockCount(self):
+      return (len(self.offsets))
+
+   # Returns (payload, rawSize, crc) for block i.  The payload is a view
+   # of the reader's buffer, only valid until the next call.
+   def readPayload(self, i):
+      offset=self.offsets[i]
+      self.file.seek(offset)
+      size, rawSize, crc=BLOCKHEADER.unpack(self.file.read(BLOCKHEADER.size))
+      if (offset+BLOCKHEADER.size+size>self.indexOffset or rawSize>self.blockSize):
+         raise RLEError(f"Block {i} has a damaged header")
+      if (size>len(self.buffer)):
+         # Sized once for the largest payload a block can have.  It is a
+         # new buffer, as views of the old one may still be held.
+         self.buffer=bytearray(max(size, maxPayload(min(self.blockSize, self.rawSize))))
+      payload=memoryview(self.buffer)[:size]
+      if (self.file.readinto(payload)!=size):
+         raise RLEError(f"Block {i} is truncated")
+      return (payload, rawSize, crc)
+
+   # Decodes block i into a new bytearray, checking its checksum.
+   def readBlock(self, i):
+      payload, rawSize, crc=self.readPayload(i)
+      return (expandPayload(payload, rawSize, crc, i))
+
+   # Decodes raw bytes [start, start+length) touching only the blocks
+   # that hold them.
+   def read(self, start, length):
+      start=max(0, start)
+      end=min(self.rawSize, start+length)
+      if (start>=end):
+         return (b"")
+      out=bytearray()
+      first=start//self.blockSize
+      last=(end-1)//self.blockSize
+      for i in range(first, last+1):
+         block=self.readBlock(i)
+         base=i*self.blockSize
+         out+=memoryview(block)[max(start, base)-base:min(end, base+len(block))-base]
+      return (bytes(out))
+
+# Worker: decodes block i, whose header is at offset in the file at
+# path.  Returns the raw bytes.
+def decodeAt(path, offset, i):
+   file=open(path, "rb")
+   file.seek(offset)
+   size, rawSize, crc=BLOCKHEADER.unpack(file.read(BLOCKHEADER.size))
+   payload=file.read(size)
+   file.close()
+   return (bytes(expandPayload(payload, rawSize, crc, i)))
+
+# Runs fn(*task) for each task on the executor, keeping at most depth
+# tasks in flight, and yields the results in task order.  The bounded
+# queue caps memory at depth blocks however large the file is.
+def orderedMap(executor, fn, tasks, depth):
+   import collections
+   pending=collections.deque()
+   for task in tasks:
+      pending.append(executor.submit(fn, *task))
+      if (len(pending)>=depth):
+         yield (pending.popleft().result())
+   while pending:
+      yield (pending.popleft().result())
+
+# Decodes and verifies one block's payload; returns a new bytearray.
+def expandPayload(payload, rawSize, crc, i=0):
+   out=bytearray(rawSize)
+   expandInto(payload, out, crc, i)
+   return (out)
+
+# Decodes and verifies one block's payload into out, a writable buffer
+# of exactly the block's raw size.
+def expandInto(payload, out, crc, i=0):
+   decodeBlock(payload, out)
+   if (zlib.crc32(out)!=crc):
+      raise RLEError(f"Checksum mismatch in block {i}")
@@ -0,0 +1,144 @@
+# Tests for the RLE container format and the urle.py decoder.
+# The tools are run as scripts, as a shell pipeline would, so their exit
+# status and output files are checked too.
+
+import io
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import unittest
+
+HERE=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, HERE)
+import rle
+
+MB=1024*1024
+
+# Mixed runs and noise, like fsm-bench.py's RLE input
+def makeData(size, seed=6722301):
+   rnd=random.Random(seed)
+   data=bytearray()
+   while (len(data)<size):
+      if (rnd.random()<0.5):
+         data+=bytes((rnd.randrange(256),))*rnd.randrange(3, 400)
+      else:
+         data+=rnd.randbytes(rnd.randrange(1, 200))
+   del data[size:]
+   return (bytes(data))
+
+# Runs one of the tools; returns the CompletedProcess.
+def tool(name, *args):
+   return (subprocess.run([sys.executable, os.path.join(HERE, name)]+list(args),
+                          capture_output=True, text=True))
+
+class TestContainer(unittest.TestCase):
+   def setUp(self):
+      self.tmp=tempfile.TemporaryDirectory()
+      self.dir=self.tmp.name
+
+   def tearDown(self):
+      self.tmp.cleanup()
+
+   def path(self, name):
+      return (os.path.join(self.dir, name))
+
+   def write(self, name, data):
+      file=open(self.path(name), "wb")
+      file.write(data)
+      file.close()
+      return (self.path(name))
+
+   def read(self, name):
+      file=open(self.path(name), "rb")
+      data=file.read()
+      file.close()
+      return (data)
+
+   # Encodes data with fsm-rle.py; returns the container's path.
+   def encode(self, data):
+      infile=self.write("input.bin", data)
+      r=tool("fsm-rle.py", infile)
+      self.assertEqual(r.returncode, 0, r.stderr)
+      return (infile+".rle")
+
+   # Checks that urle.py fails cleanly: status 1, a message naming the
+   # problem, no traceback and no output file left behind.
+   def assertRejected(self, container, message, *args):
+      r=tool("urle.py", container, self.path("output.bin"), *args)
+      self.assertEqual(r.returncode, 1, r.stdout+r.stderr)
+      self.assertIn(message, r.stdout)
+      self.assertNotIn("Traceback", r.stderr)
+      self.assertFalse(os.path.exists(self.path("output.bin")))
+
+   def test_roundTrip(self):
+      data=makeData(2*MB+12345)
+      container=self.encode(data)
+      for jobs in ("--jobs=1", "--jobs=2"):
+         r=tool("urle.py", container, self.path("output.bin"), jobs)
+         self.assertEqual(r.returncode, 0, r.stderr)
+         self.assertEqual(self.read("output.bin"), data)
+
+   def test_roundTripEmpty(self):
+      container=self.encode(b"")
+      r=tool("urle.py", container, self.path("output.bin"))
+      self.assertEqual(r.returncode, 0, r.stderr)
+      self.assertEqual(self.read("output.bin"), b"")
+
+   def test_rangeAcrossBlocks(self):
+      data=makeData(2*MB+12345)
+      container=self.encode(data)
+      start=rle.BLOCKSIZE-100
+      r=tool("urle.py", container, self.path("output.bin"), f"--range={start}:300")
+      self.assertEqual(r.returncode, 0, r.stderr)
+      self.assertEqual(self.read("output.bin"), data[start:start+300])
+
+   def test_readerRanges(self):
+      # Small blocks, so ranges cover many block boundaries
+      data=makeData(20000)
+      file=io.BytesIO()
+      writer=rle.Writer(file, blockSize=1000)
+      for o in range(0, len(data), 1000):
+         writer.writeBlock(data[o:o+1000])
+      writer.close()
+      reader=rle.Reader(file)
+      self.assertEqual(reader.blockCount(), 20)
+      for start, length in ((0, 20000), (999, 2), (1500, 7000), (19990, 100), (20000, 5)):
+         self.assertEqual(reader.read(start, length), data[start:start+length])
+
+   def test_checksumMismatch(self):
+      container=self.encode(makeData(100000))
+      data=bytearray(self.read(os.path.basename(container)))
+      # The first block's crc field
+      data[rle.HEADER.size+8]^=0xFF
+      self.write("bad.rle", data)
+      self.assertRejected(self.path("bad.rle"), "Checksum mismatch in block 0")
+      self.assertRejected(self.path("bad.rle"), "Checksum mismatch in block 0", "--jobs=2")
+
+   def test_damagedPayload(self):
+      container=self.encode(makeData(100000))
+      data=bytearray(self.read(os.path.basename(container)))
+      for offset in (25, 40, 1000):
+         damaged=bytearray(data)
+         damaged[offset]^=0xFF
+         self.write("bad.rle", damaged)
+         self.assertRejected(self.path("bad.rle"), "bad.rle: ")
+
+   def test_truncated(self):
+      container=self.encode(makeData(3*MB))
+      data=self.read(os.path.basename(container))
+      for size in (len(data)-1, len(data)//2, 5):
+         self.write("cut.rle", data[:size])
+         self.assertRejected(self.path("cut.rle"), "cut.rle: ")
+
+   def test_legacyWithMagic(self):
+      # Runs of 70 'R', 76 'E' and 3 'A' start with the bytes "FRLE"
+      legacy=self.write("legacy.rle", bytes((70, 82, 76, 69, 3, 65)))
+      self.assertRejected(legacy, "legacy.rle: ")
+      r=tool("urle.py", legacy, self.path("output.bin"), "--legacy")
+      self.assertEqual(r.returncode, 0, r.stderr)
+      self.assertEqual(self.read("output.bin"), b"R"*70+b"E"*76+b"A"*3)
+
+if __name__=="__main__":
+   unittest.main()
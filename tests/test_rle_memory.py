@@ -0,0 +1,127 @@
+# Allocation tests for the RLE encoder and decoders.
+# The hot loops write into preallocated, reused buffers, so the memory
+# traced while they run must not grow with the amount of data.  Each
+# test measures the peak traced allocation for a small and a large input
+# and checks that the difference stays under a fixed budget.
+
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import rle
+import urle
+
+MB=1024*1024
+BLOCKSIZE=256*1024
+
+# Most the traced peak may grow between the small and large inputs.
+# A leak of even a few bytes per block or pair would blow well past it.
+BUDGET=64*1024
+
+# Mixed runs and noise, like fsm-bench.py's RLE input
+def makeData(megabytes):
+   rnd=random.Random(6722301)
+   data=bytearray()
+   while (len(data)<megabytes*MB):
+      if (rnd.random()<0.5):
+         data+=bytes((rnd.randrange(256),))*rnd.randrange(3, 400)
+      else:
+         data+=rnd.randbytes(rnd.randrange(1, 200))
+   del data[megabytes*MB:]
+   return (data)
+
+# Discards writes, so output doesn't count against the budget
+class NullFile():
+   def write(self, data):
+      return (len(data))
+
+# Returns the peak traced allocation while fn() runs.
+def tracedPeak(fn):
+   tracemalloc.start()
+   try:
+      tracemalloc.reset_peak()
+      base=tracemalloc.get_traced_memory()[0]
+      fn()
+      return (tracemalloc.get_traced_memory()[1]-base)
+   finally:
+      tracemalloc.stop()
+
+# Runs a urle.py function with its module-global config set to settings,
+# restoring the config afterwards.  Returns the traced peak.
+def tracedUrle(fn, **settings):
+   saved=dict(urle.config)
+   urle.config.clear()
+   urle.config.update(settings)
+   try:
+      return (tracedPeak(fn))
+   finally:
+      urle.config.clear()
+      urle.config.update(saved)
+
+class TestRLEMemory(unittest.TestCase):
+   def assertBounded(self, small, large):
+      self.assertLess(large-small, BUDGET,
+                      f"Peak grew from {small:,} to {large:,} bytes with the input size")
+
+   def test_encodeBlock(self):
+      def peak(data):
+         view=memoryview(data)
+         out=bytearray(rle.maxPayload(BLOCKSIZE))
+         def encode():
+            for o in range(0, len(data), BLOCKSIZE):
+               rle.encodeBlock(view[o:o+BLOCKSIZE], out)
+         return (tracedPeak(encode))
+      self.assertBounded(peak(makeData(1)), peak(makeData(4)))
+
+   def test_writer(self):
+      def peak(data):
+         view=memoryview(data)
+         writer=rle.Writer(NullFile(), BLOCKSIZE)
+         def encode():
+            for o in range(0, len(data), BLOCKSIZE):
+               writer.writeBlock(view[o:o+BLOCKSIZE])
+         return (tracedPeak(encode))
+      self.assertBounded(peak(makeData(1)), peak(makeData(4)))
+
+   # Drives the real container decode loop, urle.expandContainer(), which
+   # reads each payload into the Reader's buffer and expands it into one
+   # reused output buffer
+   def test_expandContainer(self):
+      def peak(data, tmp):
+         infile=os.path.join(tmp, f"container{len(data)}.rle")
+         file=open(infile, "wb")
+         writer=rle.Writer(file, BLOCKSIZE)
+         view=memoryview(data)
+         for o in range(0, len(data), BLOCKSIZE):
+            writer.writeBlock(view[o:o+BLOCKSIZE])
+         writer.close()
+         file.close()
+         return (tracedUrle(urle.expandContainer, infile=infile,
+                            outfile=os.path.join(tmp, "container.out"),
+                            jobs=1, legacy=False))
+      with tempfile.TemporaryDirectory() as tmp:
+         self.assertBounded(peak(makeData(1), tmp), peak(makeData(4), tmp))
+
+   # The legacy decoder is a per-pair Python loop, which is slow under
+   # tracemalloc, so it gets smaller inputs
+   def test_expandLegacy(self):
+      # Run lengths 1 to 8
+      runs=bytes(1+b%8 for b in range(256))
+      def peak(size, tmp):
+         pairs=bytearray(random.Random(size).randbytes(size))
+         pairs[0::2]=pairs[0::2].translate(runs)
+         infile=os.path.join(tmp, f"legacy{size}.rle")
+         file=open(infile, "wb")
+         file.write(pairs)
+         file.close()
+         return (tracedUrle(urle.expandLegacy, infile=infile,
+                            outfile=os.path.join(tmp, "legacy.out")))
+      with tempfile.TemporaryDirectory() as tmp:
+         self.assertBounded(peak(MB//4, tmp), peak(MB, tmp))
+
+if __name__=="__main__":
+   unittest.main()
@@ -1,5 +1,8 @@
 # URLE- expands an rle compressed file.
+# Reads both the block container written by fsm-rle.py (see rle.py)
+# and legacy <run> <byte> pair files.
 import os
+import rle
 import sys
 argv=sys.argv
 argc=(len(argv))
@@ -7,53 +10,147 @@ argc=(len(argv))
 # Global
 config = dict()
 
+# Input is read in chunks of this many bytes (must be even)
+CHUNK=16*1024
+
+# Run table: 255 copies of every byte value, back to back.  A run of
+# <run> copies of <byte> is then just a slice of it, so expanding never
+# builds a new bytes object.
+RUNS=b"".join(bytes((b,))*255 for b in range(256))
+
+# A file with the container magic is always read as a container, so a
+# damaged one is reported rather than expanded into garbage.  --legacy
+# forces the pair format, for legacy files that happen to start with
+# the magic.
 def expandFile():
+   infile=open(config["infile"], "rb")
+   container=rle.isContainer(infile)
+   infile.close()
+   if container and not config["legacy"]:
+      expandContainer()
+   else:
+      expandLegacy()
+
+# Expands the block container, or only the requested byte range.  Each
+# block is decoded into one reused buffer and its checksum verified.  A
+# damaged container removes the partial output and exits with status 1.
+def expandContainer():
    infile=open(config["infile"], "rb")
    outfile=open(config["outfile"], "wb+")
-   while not eof(infile):
-      run=int.from_bytes(infile.read(1), "big")
-      b=infile.read(1)
-      for i in range(run):
-         outfile.write(b)
+   try:
+      reader=rle.Reader(infile)
+      if "range" in config:
+         start, length=config["range"]
+         outfile.write(reader.read(start, length))
+      elif config["jobs"]>1:
+         # Blocks decode on worker processes and are written in order;
+         # at most 2*jobs blocks are held in memory at once.
+         from concurrent.futures import ProcessPoolExecutor
+         tasks=((config["infile"], offset, i) for i, offset in enumerate(reader.offsets))
+         with ProcessPoolExecutor(config["jobs"]) as pool:
+            for block in rle.orderedMap(pool, rle.decodeAt, tasks, 2*config["jobs"]):
+               outfile.write(block)
+      else:
+         outbuf=bytearray(reader.blockSize)
+         outview=memoryview(outbuf)
+         for i in range(reader.blockCount()):
+            payload, rawSize, crc=reader.readPayload(i)
+            rle.expandInto(payload, outview[:rawSize], crc, i)
+            outfile.write(outview[:rawSize])
+         outview.release()
+   except rle.RLEError as e:
+      infile.close()
+      outfile.close()
+      os.remove(config["outfile"])
+      print (f"{config['infile']}: {e}")
+      sys.exit(1)
    infile.close()
    outfile.close()
 
-   
+# Expands a legacy pair file.
+def expandLegacy():
+   # Parity check / legacy RLEs can't have odd byte file size
+   if (os.path.getsize(config["infile"]) %2 ==1):
+      print (f"{config['infile']} is not a valid RLE file.")
+      sys.exit(1)
+
+   # Reused buffers: one input chunk, and the largest possible
+   # expansion of it (every pair a run of 255).
+   inbuf=bytearray(CHUNK)
+   inview=memoryview(inbuf)
+   outbuf=bytearray(CHUNK//2*255)
+   outview=memoryview(outbuf)
+   table=memoryview(RUNS)
+
+   infile=open(config["infile"], "rb")
+   outfile=open(config["outfile"], "wb+")
+   carry=0
+   while True:
+      n=infile.readinto(inview[carry:])
+      if not n:
+         break
+      have=carry+n
+      end=have-(have%2)
+      o=0
+      for i in range(0, end, 2):
+         run=inview[i]
+         t=inview[i+1]*255
+         outview[o:o+run]=table[t:t+run]
+         o+=run
+      outfile.write(outview[:o])
+
+      # A short read can split a pair; keep the odd byte for next time
+      carry=have-end
+      if carry:
+         inview[0]=inview[end]
+   infile.close()
+   outfile.close()
+   inview.release()
+   outview.release()
+   table.release()
+
 def showSyntax():
    s='''
 URLE -> Un-Run Length Encode
 August 2021 Karim Sultan
 
-Syntax: unrle.py <infile> [outfile]
+Syntax: unrle.py <infile> [outfile] [--range=<start>:<length>] [--jobs=N] [--legacy]
 
 Outfile is optional, otherwise uses infile.ext from infile.ext.rle format.
-Decodes RLE files generated by fsmrle.py.
+Decodes RLE files generated by fsmrle.py, including legacy files.
+--range expands only <length> bytes from offset <start>, reading only
+the blocks that hold them (container files only).
+--jobs decodes blocks on N worker processes (container files only).
+--legacy reads infile as a legacy file even if it starts with the
+container header's "FRLE" (a legacy file can: runs of 70 'R', 76 'E').
 '''
    print(s)
    exit()
 
 def doHouseKeeping():
-   if argc>=2:
-      config["infile"]=argv[1]
+   config["jobs"]=1
+   config["legacy"]=False
+   args=[]
+   for arg in argv[1:]:
+      if (arg=="--legacy"):
+         config["legacy"]=True
+      elif arg.startswith("--jobs="):
+         config["jobs"]=max(1, int(arg[len("--jobs="):]))
+      elif arg.startswith("--range="):
+         start,_,length=arg[len("--range="):].partition(":")
+         config["range"]=(int(start), int(length))
+      else:
+         args.append(arg)
+
+   if len(args)>=1:
+      config["infile"]=args[0]
 
-   if argc==3:
-      config["outfile"]=argv[2]
+   if len(args)==2:
+      config["outfile"]=args[1]
    else:
       outfile,e=os.path.splitext(config["infile"])
       config["outfile"]=outfile
    print(config)
-   # Quick parity check / RLEs can't have odd byte file size
-   if (os.path.getsize(config["infile"]) %2 ==1):
-      print (f"{config['infile']} is not a valid RLE file.")
-      exit()
-
-# Detects EOF.  Python should have this built in.
-def eof(f):
-   cur = f.tell()    # save current position
-   f.seek(0, os.SEEK_END)
-   end = f.tell()    # find the size of file
-   f.seek(cur, os.SEEK_SET)
-   return cur == end
 
 def main():
    if (argc<2):